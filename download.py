@@ -3,8 +3,9 @@ import glob
 import json
 import logging
 import os
+import random
 import re
-import shutil
+import signal
 import sys
 import time
 
@@ -26,8 +27,14 @@ class Downloader(object):
     def __init__(self):
         self._load_config(CONFIG_FILE)
 
+        # Seconds to wait when connecting, and between bytes received, for
+        # API calls and downloading files, so a stalled connection can't hang
+        # forever. A timeout raises a requests.exceptions.RequestException.
+        self.timeout = (10, 60)
+
         self.api = flickrapi.FlickrAPI(self.api_key, self.api_secret,
-                                        format='parsed-json')
+                                        format='parsed-json',
+                                        timeout=self.timeout)
 
         # Will be 'favorites' or 'photos_of_me'.
         self.kind = None
@@ -48,6 +55,31 @@ class Downloader(object):
         # Will store the complete data about photos downloaded.
         self.results = []
 
+        # The Flickr User ID of the authenticating user, once fetched.
+        self.nsid = None
+
+        # Used for downloading files, so connections are kept open and
+        # re-used between downloads.
+        self.session = requests.Session()
+
+        # Will be True when we're running continuously, via watch().
+        self.watching = False
+
+        # While watching, how many times we've failed to download each photo,
+        # keyed by photo ID, so that we don't try them forever.
+        self.failed_photo_attempts = {}
+
+        # How many times to try downloading a photo while watching, once per
+        # sync, before giving up on it.
+        self.max_download_attempts = 5
+
+        # The IDs of any photos we couldn't download in the current fetch.
+        self.failed_photo_ids = []
+
+        # Will store the current state while watching, written to
+        # self.watch_status_file.
+        self.status = {}
+
     def _load_config(self, config_file):
         config = configparser.ConfigParser()
 
@@ -60,6 +92,12 @@ class Downloader(object):
         self.api_key = config.get('Flickr API', 'Key')
         self.api_secret = config.get('Flickr API', 'Secret')
 
+        # Optional settings for watch(); all in seconds except the filename.
+        self.watch_interval = config.getint('Watch', 'Interval', fallback=900)
+        self.watch_jitter = config.getint('Watch', 'Jitter', fallback=60)
+        self.watch_status_file = config.get(
+                            'Watch', 'StatusFile', fallback='watch_status.json')
+
     def authorize(self):
         """
         Get the OAuth token.
@@ -109,17 +147,169 @@ class Downloader(object):
 
         self._start_fetching()
 
+    def watch(self):
+        """
+        Keep running, fetching any new favorites and 'photos of me' every
+        self.watch_interval seconds, give or take up to self.watch_jitter
+        seconds.
+        The current state is written to self.watch_status_file, which can be
+        used for health checks.
+        """
+        if not self.api.token_valid(perms='read'):
+            logger.critical("This account isn't authorised yet. Run 'python download.py authorize' first.")
+            exit()
+
+        # Only need to do this once, rather than on every sync.
+        self._fetch_user_info()
+
+        self.watching = True
+
+        self.status = {
+            'pid': os.getpid(),
+            'state': 'starting',
+            'started': self._make_timestamp(),
+            'interval': self.watch_interval,
+            'last_sync_started': None,
+            'last_sync_finished': None,
+            'last_success': None,
+            'last_error': None,
+            'last_error_at': None,
+            'next_sync': None,
+            'downloaded': {'favorites': 0, 'photos_of_me': 0},
+            # The IDs of photos that failed in the most recent sync.
+            'failed': {'favorites': [], 'photos_of_me': []},
+            # The IDs of photos we've stopped trying to download.
+            'given_up': [],
+        }
+        self._update_status()
+
+        logger.info("Watching for new photos every {} seconds".format(
+                                                        self.watch_interval))
+
+        # So that stopping us with SIGTERM (e.g. `kill`, systemd, docker)
+        # updates the status file just like Ctrl-C does.
+        signal.signal(signal.SIGTERM, self._handle_sigterm)
+
+        try:
+            while True:
+                self._watch_sync()
+
+                delay = self.watch_interval + random.uniform(
+                                        -self.watch_jitter, self.watch_jitter)
+                delay = max(delay, 0)
+
+                self._update_status(
+                    state='sleeping',
+                    next_sync=self._make_timestamp(time.time() + delay))
+
+                time.sleep(delay)
+        except KeyboardInterrupt:
+            logger.info("Stopped watching")
+            self._update_status(state='stopped', next_sync=None)
+
+    def _handle_sigterm(self, signum, frame):
+        """
+        Treat SIGTERM like Ctrl-C, so watch() stops in the same way.
+        """
+        raise KeyboardInterrupt
+
+    def _watch_sync(self):
+        """
+        Fetch any new favorites and 'photos of me' once, while watching.
+        An error with one kind is logged and recorded in the status, but
+        doesn't stop us watching.
+        """
+        self._update_status(state='syncing',
+                            last_sync_started=self._make_timestamp())
+
+        errors = []
+
+        for kind, fetcher in [('favorites', self.get_favorites),
+                              ('photos_of_me', self.get_photos_of_me)]:
+            try:
+                fetcher()
+            except (FlickrError, requests.exceptions.RequestException,
+                    OSError) as e:
+                logger.error("Error when syncing {}: {}".format(kind, e))
+                errors.append('{}: {}'.format(kind, e))
+            except Exception as e:
+                # Anything unexpected too, so that one bad sync doesn't stop
+                # us watching. With the traceback, as it's probably a bug.
+                logger.exception("Error when syncing {}: {}".format(kind, e))
+                errors.append('{}: {}'.format(kind, e))
+            else:
+                num_failed = len(self.failed_photo_ids)
+                self.status['downloaded'][kind] += (
+                                            len(self.results) - num_failed)
+                if num_failed > 0:
+                    errors.append("{}: couldn't download {} photo{}: {}".format(
+                                    kind, num_failed,
+                                    self._pluralize(num_failed),
+                                    ', '.join(self.failed_photo_ids)))
+
+            self.status['failed'][kind] = self.failed_photo_ids
+
+        given_up = [id for id, attempts in self.failed_photo_attempts.items()
+                        if attempts >= self.max_download_attempts]
+        self.status['given_up'] = sorted(given_up)
+
+        now = self._make_timestamp()
+
+        if len(errors) == 0:
+            # Clear any previous error, so it's clear it's not current.
+            self._update_status(last_sync_finished=now, last_success=now,
+                                last_error=None, last_error_at=None)
+        else:
+            self._update_status(last_sync_finished=now,
+                                last_error='; '.join(errors),
+                                last_error_at=now)
+
+    def _update_status(self, **kwargs):
+        """
+        Update self.status with any supplied values and write it all to
+        self.watch_status_file as JSON.
+        Writes to a temporary file first so that anything reading the status
+        file never sees a half-written one.
+        """
+        self.status.update(kwargs)
+        self.status['updated'] = self._make_timestamp()
+
+        path = os.path.join(os.getcwd(), self.watch_status_file)
+        tmp_path = '{}.tmp'.format(path)
+
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write( json.dumps(self.status, indent=2) )
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error("Couldn't write status file {}: {}".format(path, e))
+
+    def _make_timestamp(self, t=None):
+        """
+        Returns a UTC ISO 8601 string for the time `t` (seconds since the
+        epoch), or for now if `t` is None.
+        """
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(t))
+
     def _start_fetching(self):
         """
         Starts the entire process, once self.kind has been set.
         """
+        # Start afresh, in case we've fetched before (when watching).
+        self.page_number = 1
+        self.total_pages = 1
+        self.photo_ids_to_fetch = []
+        self.results = []
+        self.failed_photo_ids = []
+
         self._set_paths()
 
         self._make_directories()
 
         self._set_existing_photo_ids()
 
-        self._fetch_user_info()
+        if self.nsid is None:
+            self._fetch_user_info()
 
         self._fetch_pages()
 
@@ -129,7 +319,9 @@ class Downloader(object):
 
         self._fetch_photos()
 
-        self._make_html_file()
+        # When watching, only re-make the HTML if something's changed.
+        if not self.watching or len(self.results) > 0:
+            self._make_html_file()
 
         num_existing = len(self.existing_photo_ids)
         num_downloaded = len(self.results)
@@ -218,7 +410,15 @@ class Downloader(object):
         Just the basic data.
         """
         while self.page_number <= self.total_pages:
-            self._fetch_page()
+            found_existing = self._fetch_page()
+            if found_existing and self.watching and self.kind == 'favorites':
+                # Favorites are listed in order of when they were faved, most
+                # recent first, so once we reach ones we already have there's
+                # no need to fetch any more pages.
+                # https://www.flickr.com/services/api/flickr.favorites.getList.html
+                # people.getPhotosOf() doesn't promise any order, so we
+                # always fetch all of those pages.
+                break
             self.page_number += 1
             time.sleep(0.5) # Being nice.
 
@@ -229,10 +429,12 @@ class Downloader(object):
         """
         Fetch one page of basic data about some photos.
         Adds the fetched data to self.results.
+        Returns True if any of the photos had already been downloaded.
         """
         time.sleep(0.5) # Being nice.
 
         num_photos_to_fetch = 0
+        found_existing = False
 
         try:
             if self.kind == 'photos_of_me':
@@ -246,6 +448,10 @@ class Downloader(object):
                                             per_page=self.per_page,
                                             page=self.page_number)
         except FlickrError as e:
+            if self.watching:
+                # Give up on this sync, but keep watching. The error is
+                # logged by _watch_sync().
+                raise
             logger.critical(
                 "Error when fetching recent photos (page {}): {}".format(
                                                         self.page_number, e))
@@ -258,7 +464,10 @@ class Downloader(object):
             # Just save the photo IDs. All we need for now.
             # Only for photos we don't already have from a previous run.
             for photo in photos['photos']['photo']:
-                if photo['id'] not in self.existing_photo_ids:
+                if photo['id'] in self.existing_photo_ids:
+                    found_existing = True
+                elif self.failed_photo_attempts.get(photo['id'], 0) < \
+                                                self.max_download_attempts:
                     self.photo_ids_to_fetch.append(photo['id'])
                     num_photos_to_fetch += 1
 
@@ -267,6 +476,8 @@ class Downloader(object):
                 "Fetched one page of data: {} photo{} to download".format(
                     num_photos_to_fetch, self._pluralize(num_photos_to_fetch)))
 
+        return found_existing
+
     def _fetch_extra_data(self):
         """
         Now we've got the IDs of the photos, we go through and fetch
@@ -280,6 +491,7 @@ class Downloader(object):
 
         for id in self.photo_ids_to_fetch:
             self.results.append({
+                'id': id,
                 'info': self._fetch_photo_info(id),
                 'sizes': self._fetch_photo_sizes(id),
                 'exif': self._fetch_photo_exif(id),
@@ -347,8 +559,11 @@ class Downloader(object):
         """
         Having got all the data in self.results, save it to JSON files.
         """
-        # for photo in self.results:
         for photo in self.results:
+            if photo['info'] is None:
+                # We can't name the files without the info.
+                continue
+
             base_filename = self._make_filename(photo['info'])
 
             for kind in ['info', 'exif', 'sizes']:
@@ -369,7 +584,7 @@ class Downloader(object):
         logger.info("Downloading photo file{}".format(self._pluralize(len(self.results))))
 
         for photo in self.results:
-            if photo['sizes'] is not None:
+            if photo['info'] is not None and photo['sizes'] is not None:
                 if photo['info']['media'] == 'video':
                     # Accepted video formats:
                     # https://help.yahoo.com/kb/flickr/sln15628.html
@@ -398,12 +613,38 @@ class Downloader(object):
                     logger.error(
                         "Couldn't find the URL to download for photo {}".format(
                                                         photo['info']['id']))
+                    self._add_failed_photo(photo['id'])
+                    continue
 
                 download_filepath = self._download_file(url, content_types)
 
                 if download_filepath is not None:
                     save_filepath = self._make_photo_filepath(photo['info'])
                     os.rename(download_filepath, save_filepath)
+                    self.failed_photo_attempts.pop(photo['id'], None)
+                else:
+                    self._add_failed_photo(photo['id'])
+            else:
+                self._add_failed_photo(photo['id'])
+
+    def _add_failed_photo(self, photo_id):
+        """
+        Remember that we couldn't download this photo during this fetch.
+        When watching, it will be tried again on the next sync, until it has
+        failed self.max_download_attempts times. After that it will only be
+        tried again by a one-off 'favorites' or 'photosof' run, or when
+        watching is restarted.
+        """
+        self.failed_photo_ids.append(photo_id)
+
+        if self.watching:
+            attempts = self.failed_photo_attempts.get(photo_id, 0) + 1
+            self.failed_photo_attempts[photo_id] = attempts
+
+            if attempts >= self.max_download_attempts:
+                logger.warning(
+                    "Giving up on photo {} after {} attempts".format(
+                                                        photo_id, attempts))
 
     def _make_filename(self, photo_info):
         """
@@ -484,9 +725,12 @@ class Downloader(object):
         """
         logger.info("Downloading {}".format(url))
 
+        filepath = None
+
         try:
             # From http://stackoverflow.com/a/13137873/250962
-            r = requests.get(url, stream=True)
+            r = self.session.get(url, stream=True,
+                                 timeout=self.timeout)
             if r.status_code == 200:
                 try:
                     if r.headers['Content-Type'] in acceptable_content_types:
@@ -494,24 +738,29 @@ class Downloader(object):
                         filename = self._get_downloaded_filename(url, r.headers)
                         filepath = '%s%s' % (self.path, filename)
                         # Save the file there:
+                        # Using iter_content() rather than r.raw so that a
+                        # read timeout is raised as a RequestException.
                         with open(filepath, 'wb') as f:
-                            r.raw.decode_content = True
-                            shutil.copyfileobj(r.raw, f)
+                            for chunk in r.iter_content(chunk_size=65536):
+                                f.write(chunk)
                         return filepath
                     else:
-                        logger.log('error',
+                        logger.error(
                         "Invalid content type ({}) when fetching {}".format(
-                                            r.headers['content_type'], url))
+                                            r.headers['Content-Type'], url))
                 except KeyError:
-                    logger.log('error',
+                    logger.error(
                         "No content_type headers found when fetching {}".format(url))
             else:
-                logger.log('error',
+                logger.error(
                                 "Got status code {} when fetching {}".format(
                                                         r.status_code, url))
         except requests.exceptions.RequestException as e:
-            logger.log('error',
+            logger.error(
                         "Something when wrong when fetching {}: {}".format(url, e))
+            # Don't leave a partly-downloaded file lying around.
+            if filepath is not None and os.path.exists(filepath):
+                os.remove(filepath)
 
         # Something went wrong if we end up here.
         return None
@@ -659,5 +908,7 @@ if __name__ == "__main__":
         downloader.get_favorites()
     elif action == 'photosof':
         downloader.get_photos_of_me()
+    elif action == 'watch':
+        downloader.watch()
     else:
-        logger.critical("Specify one of 'authorize', 'favorites' or 'photosof'.")
+        logger.critical("Specify one of 'authorize', 'favorites', 'photosof' or 'watch'.")